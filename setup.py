@@ -14,6 +14,8 @@ setup(name='distributedlock',
       packages=['distributed'],
       install_requires=[
           'click',
+          'confluent-kafka',
+          'orjson',
           'python-dotenv',
           'pysyncobj',
           'rich',
@@ -11,18 +11,18 @@ Created on @date
 @author: mlinvill
 """
 
-import copy
-import json
 import time
-from collections.abc import Iterator        # Python >= 3.9
+from collections import deque
+from collections.abc import Iterable, Iterator        # Python >= 3.9
 from typing import Callable
 import random
-import pprint
 import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor
 import queue
-from hop import Stream
+import uuid
+import orjson
+from confluent_kafka import Consumer, Message, Producer
+from hop.auth import load_auth, select_matching_auth
 from .lock import getmyip
 from .logger import getLogger
 
@@ -47,6 +47,35 @@ WRITE_TOPIC = 'snews.operations'
 MIN_PEERS = 2
 WATCHDOG_TIMEOUT = 600  # seconds
 DISCO_STARTUP_DELAY = 30  # seconds
+DISCO_JITTER = 3  # seconds, spread out the initial DISCO broadcasts
+POLL_TIMEOUT = 2.0  # seconds to wait for incoming messages per poll() tick
+SEND_TIMEOUT = 0.5  # seconds _send waits on an empty queue before checking for shutdown
+JOIN_TIMEOUT = 5  # seconds to wait for the reader/writer threads on exit
+FLUSH_TIMEOUT = 3  # seconds _send waits for outstanding deliveries on exit, < JOIN_TIMEOUT
+
+""" Consumer fetch tuning, overridable through Disco(**kwargs).
+    Let the broker accumulate data before answering a fetch, and pull
+    many messages per consume() call instead of one at a time.
+"""
+FETCH_MIN_BYTES = 65536
+FETCH_WAIT_MAX_MS = 100
+MAX_PARTITION_FETCH_BYTES = 1048576
+SOCKET_BUFFER_BYTES = 1048576
+CONSUME_BATCH_SIZE = 500
+CONSUME_TIMEOUT = 0.1  # seconds
+
+""" Producer batching, overridable through Disco(**kwargs).
+    librdkafka gathers outbound messages for up to LINGER_MS and sends them
+    together, up to SEND_BATCH_SIZE messages or BATCH_SIZE bytes per batch.
+"""
+LINGER_MS = 100
+SEND_BATCH_SIZE = 100
+BATCH_SIZE = 65536  # bytes
+COMPRESSION_TYPE = 'lz4'
+
+""" Outbound messages are dropped once this many are waiting to be written.
+"""
+OUT_QUEUE_SIZE = 15
 
 log = getLogger('distributed_lock')
 log.setLevel(logging.DEBUG)
@@ -75,6 +104,8 @@ class Id(dict):
     Need to handle ports also.
     """
 
+    __slots__ = ("_myip",)
+
     def __init__(self):
         dict.__init__(self)
         self._myip = getmyip()
@@ -84,6 +115,63 @@ class Id(dict):
         return self._myip
 
 
+class SPSCQueue:
+    """
+    Single-producer/single-consumer work queue.
+
+    deque.append()/popleft() are atomic in CPython, so the only synchronization
+    needed is an Event to wake a blocked reader. maxsize=0 means unbounded.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self._items = deque()
+        self._ready = threading.Event()
+        self._maxsize = maxsize
+
+    def put(self, item) -> None:
+        """Append an item and wake the reader"""
+        self._items.append(item)
+        self._ready.set()
+
+    def get(self, timeout: float = None):
+        """Pop the oldest item, waiting up to `timeout` seconds. Raise queue.Empty on time-out"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                self._ready.clear()
+                if self._items:
+                    continue
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty from None
+                self._ready.wait(remaining)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait up to `timeout` seconds for something to get. Return True if there is"""
+        if self._items:
+            return True
+
+        self._ready.clear()
+        # put() may have appended before our clear(), look again before sleeping
+        if self._items:
+            return True
+        return self._ready.wait(timeout)
+
+    def empty(self) -> bool:
+        """Return True if there is nothing to get"""
+        return not self._items
+
+    def full(self) -> bool:
+        """Return True if a bounded queue has reached maxsize"""
+        return 0 < self._maxsize <= len(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
 class PeerList:
     """
     Object to hold our current list of discovered peers. Trigger events on status change.
@@ -92,29 +180,59 @@ class PeerList:
 
     """
 
+    __slots__ = ("_state", "_callbacks", "_lock")
+
     def __init__(self):
-        self._length = 0
         self._state = set()
         self._callbacks = []
+        self._lock = threading.Lock()
 
     def add_peer(self, peer: str) -> None:
         """Add a peer by name to the list of known peers"""
-        old_state = copy.deepcopy(self._state)
-
-        log.debug(
-            "PeerList: add_peer(): Adding {peer}, state before is {pprint.pformat(self._state)}"
-        )
-        self._state.add(peer)
-        self._length = len(self._state)
-        self._notify(old_state, self.get_state())
+        old_state = new_state = None
+        with self._lock:
+            if self._callbacks:
+                # peers are immutable strings, a shallow copy is enough
+                old_state = self._state.copy()
+            self._state.add(peer)
+            length = len(self._state)
+            if self._callbacks:
+                new_state = self._state.copy()
+
+        log.debug("PeerList: add_peer(): Added %s, %d known peers", peer, length)
+        if new_state is not None:
+            self._notify(old_state, new_state)
+
+    def add_peers(self, peers: Iterable[str]) -> None:
+        """Add several peers at once, notifying callbacks a single time"""
+        peers = list(peers)
+        old_state = new_state = None
+        with self._lock:
+            if self._callbacks:
+                old_state = self._state.copy()
+            self._state.update(peers)
+            length = len(self._state)
+            if self._callbacks:
+                new_state = self._state.copy()
+
+        log.debug("PeerList: add_peers(): Added %s, %d known peers", peers, length)
+        if new_state is not None:
+            self._notify(old_state, new_state)
 
     def remove_peer(self, peer: str) -> None:
         """Remove a peer by name from the list of known peers"""
-        old_state = copy.deepcopy(self._state)
-
-        self._state.discard(peer)
-        self._length = len(self._state)
-        self._notify(old_state, self.get_state())
+        old_state = new_state = None
+        with self._lock:
+            if self._callbacks:
+                old_state = self._state.copy()
+            self._state.discard(peer)
+            length = len(self._state)
+            if self._callbacks:
+                new_state = self._state.copy()
+
+        log.debug("PeerList: remove_peer(): Removed %s, %d known peers", peer, length)
+        if new_state is not None:
+            self._notify(old_state, new_state)
 
     def register_callback(self, callback: Callable) -> None:
         """Register a function to call on peer state changes"""
@@ -125,8 +243,9 @@ class PeerList:
         self._callbacks.remove(callback)
 
     def get_state(self) -> set:
-        """Return the state"""
-        return self._state
+        """Return a snapshot of the state"""
+        with self._lock:
+            return self._state.copy()
 
     def _notify(self, old_state: set, new_state: set) -> None:
         """Call the functions that registered an interest in state changes"""
@@ -135,10 +254,10 @@ class PeerList:
 
     def __len__(self) -> int:
         """Return the number of known peers"""
-        return self._length
+        return len(self._state)
 
     def __repr__(self) -> str:
-        return pprint.pformat(self._state)
+        return f"PeerList({sorted(self.get_state())!r})"
 
 
 class Disco:
@@ -159,19 +278,36 @@ class Disco:
         self._broker = None
         self._read_topic = None
         self._write_topic = None
-        self._stream_uri_r = None
-        self._stream_uri_w = None
         self._stream_r = None
         self._stream_w = None
         self._in_disco = False
         self._peerlist = PeerList()
         self._id = None
-        self._executor = None
+        self._myip = None
+        self._disco_msg = None
+        self._reply_msg = None
+        self._end_msg = None
         self._thrds = dict()
-        self._in_queue = queue.Queue(maxsize=15)
-        self._out_queue = queue.Queue(maxsize=15)
+        self._in_queue = SPSCQueue()
+        self._out_queue = SPSCQueue(maxsize=OUT_QUEUE_SIZE)
         self._event = threading.Event()
         self._endit = False
+        self._replies = []
+        self._handlers = {
+            "END": self._on_end,
+            "DISCO": self._on_disco,
+            "REPLY": self._on_reply,
+        }
+        self._fetch_min_bytes = FETCH_MIN_BYTES
+        self._fetch_wait_max_ms = FETCH_WAIT_MAX_MS
+        self._max_partition_fetch_bytes = MAX_PARTITION_FETCH_BYTES
+        self._consume_batch_size = CONSUME_BATCH_SIZE
+        self._consume_timeout = CONSUME_TIMEOUT
+        self._linger_ms = LINGER_MS
+        self._send_batch_size = SEND_BATCH_SIZE
+        self._batch_size = BATCH_SIZE
+        self._compression_type = COMPRESSION_TYPE
+        self._socket_buffer_bytes = SOCKET_BUFFER_BYTES
 
         """ setup broker, topic attributes
         """
@@ -179,75 +315,161 @@ class Disco:
             key = f"_{k}"
             self.__dict__[key] = val
 
-        if self._broker:
-            if self._read_topic:
-                if "kafka://" in self._broker.lower():
-                    self._stream_uri_r = f"kafka://{self._broker}/{self._read_topic}"
-                else:
-                    self._stream_uri_r = f"kafka://{self._broker}/{self._read_topic}"
-
-            if self._write_topic:
-                if "kafka" in self._broker.lower():
-                    self._stream_uri_w = f"kafka://{self._broker}/{self._write_topic}"
-                else:
-                    self._stream_uri_w = f"kafka://{self._broker}/{self._write_topic}"
-        else:
+        if not self._broker:
             raise MissingArgumentError
 
+        # accept the broker with or without a scheme; kafka clients want a bare host
+        if self._broker.startswith("kafka://"):
+            self._broker = self._broker[len("kafka://"):]
+
         # Determine my address
         self._id = Id()
         if self._id is None:
             raise NetworkError
+        self._myip = self._id.getmyip()
+
+        # protocol payloads only depend on our address, encode them once
+        self._disco_msg = orjson.dumps({"action": "DISCO", "source": self._myip})
+        self._reply_msg = orjson.dumps(
+            {"action": "REPLY", "reply": self._myip, "source": self._myip}
+        )
+        self._end_msg = orjson.dumps({"action": "END", "source": self._myip})
+
+    def _kafka_config(self) -> dict:
+        """Build the confluent_kafka configuration shared by reader and writer,
+           including hop credentials
+        """
+        # disco messages are tiny request/response pairs, don't let Nagle hold them back
+        config = {
+            "bootstrap.servers": self._broker,
+            "socket.nagle.disable": True,
+            "socket.keepalive.enable": True,
+            "socket.send.buffer.bytes": self._socket_buffer_bytes,
+            "socket.receive.buffer.bytes": self._socket_buffer_bytes,
+        }
+
+        auth = self._auth
+        if auth is True:
+            auth = select_matching_auth(load_auth(), self._broker)
+        if auth:
+            config.update(auth())
+
+        return config
+
+    def _consumer_config(self) -> dict:
+        """Build the confluent_kafka consumer configuration"""
+        config = self._kafka_config()
+        config.update({
+            "group.id": uuid.uuid4().hex,
+            "auto.offset.reset": "latest",
+            "fetch.min.bytes": self._fetch_min_bytes,
+            "fetch.wait.max.ms": self._fetch_wait_max_ms,
+            "max.partition.fetch.bytes": self._max_partition_fetch_bytes,
+        })
+        return config
+
+    def _producer_config(self) -> dict:
+        """Build the confluent_kafka producer configuration"""
+        config = self._kafka_config()
+        config.update({
+            "linger.ms": self._linger_ms,
+            "batch.num.messages": self._send_batch_size,
+            "batch.size": self._batch_size,
+            "compression.type": self._compression_type,
+        })
+        return config
 
     def __enter__(self):
-        if self._stream_uri_r:
-            self._stream_r = Stream(until_eos=True, auth=self._auth).open(
-                self._stream_uri_r, "r"
-            )
+        if self._read_topic:
+            self._stream_r = Consumer(self._consumer_config())
+            self._stream_r.subscribe([self._read_topic])
 
-        if self._stream_uri_w:
-            self._stream_w = Stream(until_eos=True, auth=self._auth).open(
-                self._stream_uri_w, "w"
-            )
+        if self._write_topic:
+            self._stream_w = Producer(self._producer_config())
 
         time.sleep(DISCO_STARTUP_DELAY)
 
-        self._executor = ThreadPoolExecutor(max_workers=2)
-        self._thrds["recv"] = self._executor.submit(self._recv, self)
-        self._thrds["send"] = self._executor.submit(self._send, self)
+        # a read-only or write-only Disco only runs the side it has a stream for
+        if self._stream_r is not None:
+            self._thrds["recv"] = threading.Thread(target=self._recv, args=(self,), daemon=True)
+        if self._stream_w is not None:
+            self._thrds["send"] = threading.Thread(target=self._send, args=(self,), daemon=True)
+        for thrd in self._thrds.values():
+            thrd.start()
 
-        while not self._event.is_set():
-            self.discovery()
+        self.discovery()
 
         return self
 
     def __exit__(self, exception_type, exception_value, traceback) -> None:
-        self._executor.shutdown(wait=True, cancel_futures=False)
-
-        self._stream_r.close()
-        self._stream_w.close()
+        # _send/_recv close their own streams once they see the event
         self._event.set()
+        for thrd in self._thrds.values():
+            thrd.join(timeout=JOIN_TIMEOUT)
 
     @staticmethod
     def _send(self) -> None:
-        """Encapsulate the logic/method of actually writing"""
-        while not self._event.is_set():
-            for msg in [self._out_queue.get()]:
-                self._stream_w.write(msg)
+        """Encapsulate the logic/method of actually writing.
+           Batching is left to librdkafka (linger.ms/batch.size), poll() serves
+           the delivery reports.
+        """
+        try:
+            while not self._event.is_set():
+                try:
+                    msg = self._out_queue.get(timeout=SEND_TIMEOUT)
+                except queue.Empty:
+                    self._stream_w.poll(0)
+                    continue
+
+                self._stream_w.produce(self._write_topic, msg, on_delivery=self._on_delivery)
+                self._stream_w.poll(0)
+        finally:
+            # hand over whatever was queued before shutdown, e.g. a REPLY ahead of an END
+            while not self._out_queue.empty():
+                self._stream_w.produce(
+                    self._write_topic, self._out_queue.get(), on_delivery=self._on_delivery
+                )
+            undelivered = self._stream_w.flush(FLUSH_TIMEOUT)
+            if undelivered:
+                log.error("_send(): %d messages still undelivered at shutdown", undelivered)
+
+    @staticmethod
+    def _on_delivery(err, msg: Message) -> None:
+        """Delivery report from librdkafka, called from poll()/flush()"""
+        if err is not None:
+            log.error("_send(): delivery of %r failed: %s", msg.value(), err)
 
     @staticmethod
     def _recv(self) -> None:
         """Encapsulate the logic/method of actually reading"""
-        while not self._event.is_set():
-            for message in self._stream_r:
-                self._in_queue.put(message)
+        try:
+            while not self._event.is_set():
+                messages = self._stream_r.consume(
+                    num_messages=self._consume_batch_size, timeout=self._consume_timeout
+                )
+                if self._event.is_set():
+                    break
+
+                batch = []
+                for message in messages:
+                    if message.error():
+                        log.error("_recv(): kafka error %s", message.error())
+                        continue
+                    batch.append(message)
+
+                if batch:
+                    self._in_queue.put(batch)
+        finally:
+            self._stream_r.close()
 
     def discovery(self) -> None:
-        """Launch the discovery protocol. Find peers."""
-        if not self._in_disco:
-            self._in_disco = True
-            discorply = {"action": "DISCO", "source": self._id.getmyip()}
-            self.produce(json.dumps(discorply))
+        """Launch the discovery protocol. Find peers. Runs until poll() sees an END."""
+        if self._in_disco:
+            return
+
+        self._in_disco = True
+        time.sleep(random.uniform(0, DISCO_JITTER))
+        self.produce(self._disco_msg)
 
         self.poll()
 
@@ -256,55 +478,93 @@ class Disco:
            register peers, end when we have enough
         """
         while not self._endit:
-            time.sleep(1 + random.randint(0, 3))
+            self._in_queue.wait(timeout=POLL_TIMEOUT)
 
             for message in self.consume():
-                msg = json.loads(message.content)
-
-                if "END" in msg["action"]:
-                    self.shutdown()
-                    break
+                msg = self._decode(message)
+                if msg is None:
+                    continue
 
-                if self._id.getmyip() == msg["source"]:
+                # END is honored from anyone, including ourselves
+                if msg["action"] != "END" and self._myip == msg["source"]:
                     log.debug("skipping message from myself")
                     continue
 
-                if "DISCO" in msg["action"]:
-                    self._in_disco = True
-                    self.reply()
-                elif "REPLY" in msg["action"]:
-                    self._peerlist.add_peer(msg["reply"])
-                    if len(self._peerlist) >= MIN_PEERS:
-                        self.end()
-                else:
+                handler = self._handlers.get(msg["action"])
+                if handler is None:
                     raise UnknownActionError
 
+                handler(msg)
+                if self._endit:
+                    break
+
+            # register everyone who replied during this tick in one go
+            if self._replies:
+                self._peerlist.add_peers(self._replies)
+                self._replies.clear()
+                if not self._endit and len(self._peerlist) >= MIN_PEERS:
+                    self.end()
+
+    @staticmethod
+    def _decode(message: Message) -> dict:
+        """Decode a kafka message into a protocol dict, None if it isn't one.
+
+           Messages are raw JSON objects. Peers still writing through hop wrap
+           the JSON text in a JSONBlob (header _format=json), so the value is a
+           JSON-encoded string; unwrap that once.
+        """
+        try:
+            msg = orjson.loads(message.value())
+            if isinstance(msg, str):
+                msg = orjson.loads(msg)
+        except (orjson.JSONDecodeError, TypeError):
+            log.warning("poll(): skipping undecodable message %r", message.value())
+            return None
+
+        if not (
+            isinstance(msg, dict)
+            and isinstance(msg.get("action"), str)
+            and isinstance(msg.get("source"), str)
+            and (msg["action"] != "REPLY" or isinstance(msg.get("reply"), str))
+        ):
+            log.warning("poll(): skipping malformed message %r", msg)
+            return None
+
+        return msg
+
+    def _on_end(self, msg: dict) -> None:
+        """Handle an END action: discovery is over"""
+        self.shutdown()
+
+    def _on_disco(self, msg: dict) -> None:
+        """Handle a DISCO action: answer the peer looking for us"""
+        self._in_disco = True
+        self.reply()
+
+    def _on_reply(self, msg: dict) -> None:
+        """Handle a REPLY action: remember the peer, poll() registers them per batch"""
+        self._replies.append(msg["reply"])
+
     def reply(self) -> None:
         """Reply to a discovery request"""
-        rply = {
-            "action": "REPLY",
-            "reply": self._id.getmyip(),
-            "source": self._id.getmyip(),
-        }
-        self.produce(json.dumps(rply))
+        self.produce(self._reply_msg)
 
     def end(self) -> None:
         """Send the 'end' discovery protocol action"""
-        endrply = {"action": "END", "source": self._id.getmyip()}
-        self.produce(json.dumps(endrply))
+        self.produce(self._end_msg)
 
-    def produce(self, msg: str) -> None:
+    def produce(self, msg: bytes) -> None:
         """Put msg in the work queue"""
         if not self._event.is_set() and not self._out_queue.full():
-            log.debug("produce(): queueing [{msg}] for kafka")
-            self._out_queue.put(str(msg))
+            log.debug("produce(): queueing [%s] for kafka", msg)
+            self._out_queue.put(msg)
 
-    def consume(self) -> Iterator[json]:
-        """Get messages from the work queue"""
+    def consume(self) -> Iterator[Message]:
+        """Get messages from the work queue, one batch per kafka fetch"""
         while not self._in_queue.empty():
-            message = self._in_queue.get()
-            log.debug("consume(): incoming message {message} from kafka")
-            yield message
+            batch = self._in_queue.get()
+            log.debug("consume(): incoming batch of %d messages from kafka", len(batch))
+            yield from batch
 
     def shutdown(self) -> None:
         """Stop disco"""
@@ -317,7 +577,7 @@ class Disco:
 
     def whoami(self) -> str:
         """ Return my ip address """
-        return self._id.getmyip()
+        return self._myip
 
 
 def watchdog_timeout() -> None:
@@ -332,6 +592,6 @@ if __name__ == "__main__":
     watchdog.start()
 
     with Disco(broker=BROKER, read_topic=READ_TOPIC, write_topic=WRITE_TOPIC) as disco:
-        log.debug("Peers: {disco.get_peerlist()}")
+        log.debug("Peers: %s", disco.get_peerlist())
 
     watchdog.cancel()
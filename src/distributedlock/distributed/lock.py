@@ -13,6 +13,7 @@ from random import randint
 import socket
 import uuid
 from multiprocessing import Value
+from multiprocessing.synchronize import Condition
 from pysyncobj import SyncObj
 from pysyncobj.batteries import ReplLockManager
 
@@ -41,7 +42,7 @@ def getmyip() -> str:
         except Exception:
             myip = "127.0.0.1"
 
-    log.debug("getmyip() my ip is {myip}")
+    log.debug("getmyip() my ip is %s", myip)
     return myip
 
 
@@ -65,7 +66,8 @@ class DistributedLock:
     """
     Encapsulate distributed lock logic
     """
-    def __init__(self, mynode: str, peerlist: List, lockid: str, leader: Value):
+    def __init__(self, mynode: str, peerlist: List, lockid: str, leader: Value,
+                 leader_cond: Condition = None):
         self._run = True
         self.autounlocktime = 13
         self.peers = peerlist or []
@@ -80,6 +82,8 @@ class DistributedLock:
         self.lockid = lockid
         # multiprocessing Value type, leader.value: 1 for leader, 0 for follower
         self.leader = leader
+        # optional multiprocessing Condition, notified whenever leader.value changes
+        self.leader_cond = leader_cond
 
         if self.myip is None:
             self.myip = f"{getmyip()}:{STARTPORT}"
@@ -87,7 +91,7 @@ class DistributedLock:
         if len(self.peers) < 3:
             raise InvalidPeerArgumentError
 
-        log.debug("DistributedLock.__init__(): myip {self.myip} peers {self.peers}")
+        log.debug("DistributedLock.__init__(): myip %s peers %s", self.myip, self.peers)
 
     def run(self):
         """
@@ -104,7 +108,7 @@ class DistributedLock:
                 if self.lockmanager.tryAcquire(
                     self.lockid, sync=True, timeout=randint(30, 60)
                 ):
-                    log.debug("{self.myip} I have the lock!")
+                    log.debug("%s I have the lock!", self.myip)
                     # we have the write lock
                     self.setleaderstate(True)
                     sleep(10)
@@ -113,7 +117,7 @@ class DistributedLock:
                     sleep(randint(1, 15))
 
             except Exception as errmsg:
-                log.error("Exception trying to aquire lock: {errmsg}")
+                log.error("Exception trying to aquire lock: %s", errmsg)
                 self.stop()
                 raise
 
@@ -122,7 +126,7 @@ class DistributedLock:
     def stop(self) -> None:
         """ Stop the PySyncObj protocol
         """
-        log.info("{self.myip} ...Stopping.")
+        log.info("%s ...Stopping.", self.myip)
 
         self.setleaderstate(False)
         self.lockmanager.release(self.lockid, sync=True)
@@ -133,8 +137,15 @@ class DistributedLock:
         :param state:
         :return: None
         """
-        with self.leader.get_lock():
-            self.leader.value = state
+        if self.leader_cond is None:
+            with self.leader.get_lock():
+                self.leader.value = state
+            return
+
+        with self.leader_cond:
+            if self.leader.value != state:
+                self.leader.value = state
+                self.leader_cond.notify_all()
 
     def getleaderstate(self) -> int:
         """
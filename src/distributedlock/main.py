@@ -7,9 +7,9 @@ utilizing multiprocessing for process separation/isolation.
 """
 import os
 from typing import List
-from time import sleep
 import multiprocessing as mp
 from multiprocessing import Value
+from multiprocessing.synchronize import Condition
 
 from dotenv import load_dotenv
 import click
@@ -19,16 +19,22 @@ from distributed.lock import (DistributedLock, statedesc,
 #from distributed.disco import Disco
 from distributed.disco import Disco, BROKER, READ_TOPIC, WRITE_TOPIC, DiscoTimeoutError
 
-def runlock(mynode: str, peerlist: List, leader_state: Value):
+LEADER_WAIT_TIMEOUT = 5  # seconds between checks that the lock process is still alive
+# every node must contend for the same lock, so the id is fixed rather than generated
+LOCKID = "snews_distributed_lock"
+
+def runlock(mynode: str, peerlist: List, leader_state: Value, leader_cond: Condition):
     """
     Create a DistributedLock instance and run it.
 
     :param mynode: str
     :param peerlist: List
     :param leader_state: Value
+    :param leader_cond: Condition
     :return: None
     """
-    distributedlock = DistributedLock(mynode, peerlist, leader=leader_state)
+    distributedlock = DistributedLock(mynode, peerlist, lockid=LOCKID, leader=leader_state,
+                                      leader_cond=leader_cond)
     distributedlock.run()
 
 
@@ -75,18 +81,24 @@ def main(ctx=None, env=None):
 
     laststate = None
     leader = mp.Value("i", 0, lock=True)
+    # share the Value's lock so state writes and change notifications are atomic
+    leader_cond = mp.Condition(leader.get_lock())
 
-    p = mp.Process(target=runlock, args=(myhosturi, peers, leader))
+    p = mp.Process(target=runlock, args=(myhosturi, peers, leader, leader_cond))
     p.start()
 
     try:
-        while True:
-            status = leader.value
-            if laststate != status:
-                console.log(f"me: {myhosturi}\tstate: {statedesc[status]}")
-                laststate = status
+        while p.is_alive():
+            with leader_cond:
+                if not leader_cond.wait_for(lambda: leader.value != laststate,
+                                            timeout=LEADER_WAIT_TIMEOUT):
+                    continue
+                status = leader.value
+
+            console.log(f"me: {myhosturi}\tstate: {statedesc[status]}")
+            laststate = status
 
-            sleep(2)
+        console.log(f"lock process exited with code {p.exitcode}")
 
     except Exception:
         console.print_exception()
@@ -7,12 +7,15 @@ Created on 1/30/2024
 """
 
 import sys
+import queue
 from typing import List
 import multiprocessing as mp
 from multiprocessing import Value
 import threading
+import orjson
+import pytest
 from distributedlock.distributed.lock import DistributedLock, statedesc
-from distributedlock.distributed.disco import Disco, PeerList
+from distributedlock.distributed.disco import Disco, PeerList, SPSCQueue, UnknownActionError
 
 WATCHDOG_TIMEOUT = 60  # seconds
 
@@ -83,6 +86,36 @@ class TestPeerList:
 
         assert len(self.peerlist) == 3
 
+    def test_state_snapshot(self):
+        """get_state() returns a copy, not the live set"""
+        state = self.peerlist.get_state()
+        state.add("10.0.0.4")
+
+        assert "10.0.0.4" not in self.peerlist.get_state()
+        assert len(self.peerlist) == 3
+
+    def test_add_peers(self):
+        """Test adding several peers notifies callbacks once"""
+        calls = []
+        peerlist = PeerList()
+        peerlist.register_callback(lambda old, new: calls.append((old, new)))
+        peerlist.add_peers(["10.0.0.1", "10.0.0.2", "10.0.0.1"])
+
+        assert len(peerlist) == 2
+        assert calls == [(set(), {"10.0.0.1", "10.0.0.2"})]
+
+    def test_log_change(self, caplog):
+        """The debug log names the peer and the resulting peer count"""
+        peerlist = PeerList()
+        with caplog.at_level("DEBUG", logger="distributed_lock"):
+            peerlist.add_peer("10.0.0.1")
+
+        assert "add_peer(): Added 10.0.0.1, 1 known peers" in caplog.text
+
+    def test_repr(self):
+        """repr lists the peers in sorted order"""
+        assert repr(self.peerlist) == "PeerList(['10.0.0.1', '10.0.0.2', '10.0.0.3'])"
+
     def test_remove_callback(self):
         """Test removing a callback"""
         self.peerlist.deregister_callback(cb_output)
@@ -93,6 +126,265 @@ class TestPeerList:
         del self.peerlist
 
 
+class TestSPSCQueue:
+    """ Test the SPSCQueue class """
+
+    def test_fifo(self):
+        """Items come out in the order they went in"""
+        spsc = SPSCQueue()
+        spsc.put("a")
+        spsc.put("b")
+
+        assert spsc.get() == "a"
+        assert spsc.get() == "b"
+        assert spsc.empty()
+
+    def test_full(self):
+        """Bounded queue reports full at maxsize"""
+        spsc = SPSCQueue(maxsize=1)
+        assert not spsc.full()
+
+        spsc.put("a")
+        assert spsc.full()
+
+    def test_wait(self):
+        """wait() returns at once with items queued, times out without"""
+        spsc = SPSCQueue()
+        assert not spsc.wait(timeout=0.1)
+
+        spsc.put("a")
+        assert spsc.wait(timeout=0)
+
+    def test_get_timeout(self):
+        """get() on an empty queue raises queue.Empty after the timeout"""
+        spsc = SPSCQueue()
+        with pytest.raises(queue.Empty):
+            spsc.get(timeout=0.1)
+
+    def test_blocked_get_woken_by_put(self):
+        """A get() blocked in another thread returns once put() is called"""
+        spsc = SPSCQueue()
+        got = []
+        reader = threading.Thread(target=lambda: got.append(spsc.get(timeout=5)))
+        reader.start()
+        threading.Event().wait(0.2)  # let the reader block on the empty queue
+
+        spsc.put("a")
+        reader.join(timeout=5)
+
+        assert got == ["a"]
+
+    def test_producer_consumer_threads(self):
+        """Every item put() by one thread is get() by another, in order, with no lost wake-up"""
+        spsc = SPSCQueue()
+        count = 10000
+        got = []
+
+        def reader():
+            for _ in range(count):
+                got.append(spsc.get(timeout=5))
+
+        thrd = threading.Thread(target=reader)
+        thrd.start()
+        for item in range(count):
+            spsc.put(item)
+        thrd.join(timeout=10)
+
+        assert got == list(range(count))
+
+
+class FakeMessage:
+    """Stand-in for a confluent_kafka Message"""
+
+    def __init__(self, value: bytes):
+        self._value = value
+
+    def value(self) -> bytes:
+        """Return the raw payload"""
+        return self._value
+
+    def error(self):
+        """Fake messages never carry an error"""
+        return None
+
+
+class FakeProducer:
+    """Stand-in for a confluent_kafka Producer, flush() reports `undelivered` messages left"""
+
+    def __init__(self, undelivered: int = 0):
+        self.produced = []
+        self.undelivered = undelivered
+
+    def produce(self, topic: str, value: bytes, on_delivery=None):
+        """Record the message"""
+        self.produced.append((topic, value, on_delivery))
+
+    def poll(self, timeout: float) -> int:
+        """Nothing to serve"""
+        return 0
+
+    def flush(self, timeout: float) -> int:
+        """Return the number of messages still queued"""
+        return self.undelivered
+
+
+def feed(disco: Disco, *msgs: dict) -> None:
+    """Deliver one batch of protocol messages to disco as if read from kafka"""
+    disco._in_queue.put([FakeMessage(orjson.dumps(msg)) for msg in msgs])
+
+
+class TestDiscoProtocol:
+    """ Test message handling without a broker """
+
+    def setup_method(self):
+        """Disco doesn't touch the network until __enter__"""
+        self.disco = Disco(broker="localhost", read_topic="test", write_topic="test")
+        self.produced = []
+        self.disco.produce = self.loopback
+
+    def loopback(self, msg: bytes) -> None:
+        """Record what disco sends and read it straight back, like a shared topic would"""
+        self.produced.append(msg)
+        self.disco._in_queue.put([FakeMessage(msg)])
+
+    def test_dispatch(self):
+        """DISCO is answered, our own messages are skipped, END stops poll()"""
+        myip = self.disco.whoami()
+        feed(
+            self.disco,
+            {"action": "DISCO", "source": "10.0.0.1"},
+            {"action": "ENDORSE", "source": myip},
+            {"action": "END", "source": "10.0.0.1"},
+        )
+
+        self.disco.poll()
+
+        assert self.produced == [self.disco._reply_msg]
+        assert self.disco._endit
+
+    def test_reply_burst(self):
+        """REPLYs arriving in one batch update the peers once and send a single END"""
+        calls = []
+        self.disco._peerlist.register_callback(lambda old, new: calls.append((old, new)))
+        feed(
+            self.disco,
+            {"action": "REPLY", "reply": "10.0.0.1", "source": "10.0.0.1"},
+            {"action": "REPLY", "reply": "10.0.0.2", "source": "10.0.0.2"},
+            {"action": "REPLY", "reply": "10.0.0.3", "source": "10.0.0.3"},
+        )
+
+        self.disco.poll()
+
+        assert calls == [(set(), {"10.0.0.1", "10.0.0.2", "10.0.0.3"})]
+        assert self.produced == [self.disco._end_msg]
+        assert self.disco._endit
+
+    def test_unknown_action(self):
+        """Actions are matched exactly, ENDORSE is not END"""
+        feed(self.disco, {"action": "ENDORSE", "source": "10.0.0.1"})
+
+        with pytest.raises(UnknownActionError):
+            self.disco.poll()
+
+        assert not self.disco._endit
+
+    def test_broker_scheme(self):
+        """A kafka:// scheme on the broker is stripped for the kafka clients"""
+        disco = Disco(broker="kafka://localhost:9092", read_topic="test")
+
+        assert disco._broker == "localhost:9092"
+
+    def test_producer_batching(self):
+        """Outbound batching is configured on the librdkafka producer, kwargs override it"""
+        disco = Disco(broker="localhost", write_topic="test", auth=False, linger_ms=50)
+        config = disco._producer_config()
+
+        assert config["linger.ms"] == 50
+        assert config["batch.num.messages"] == 100
+        assert config["batch.size"] == 65536
+        assert config["compression.type"] == "lz4"
+
+    def test_decode(self):
+        """Raw JSON objects decode to dicts"""
+        msg = {"action": "DISCO", "source": "10.0.0.1"}
+
+        assert self.disco._decode(FakeMessage(orjson.dumps(msg))) == msg
+
+    def test_decode_hop_jsonblob(self):
+        """hop-framed JSONBlob payloads (a JSON-encoded string) are unwrapped"""
+        msg = {"action": "DISCO", "source": "10.0.0.1"}
+        blob = orjson.dumps(orjson.dumps(msg).decode())
+
+        assert self.disco._decode(FakeMessage(blob)) == msg
+
+    def test_decode_rejects_garbage(self):
+        """Non-protocol payloads decode to None instead of raising"""
+        assert self.disco._decode(FakeMessage(b"not json")) is None
+        assert self.disco._decode(FakeMessage(b"[1, 2]")) is None
+        assert self.disco._decode(FakeMessage(b'{"action": "DISCO"}')) is None
+        assert self.disco._decode(FakeMessage(None)) is None
+        assert self.disco._decode(FakeMessage(b'{"action": ["END"], "source": "x"}')) is None
+        assert self.disco._decode(FakeMessage(b'{"action": "END", "source": 1}')) is None
+        assert self.disco._decode(
+            FakeMessage(b'{"action": "REPLY", "source": "10.0.0.9"}')
+        ) is None
+        assert self.disco._decode(
+            FakeMessage(b'{"action": "REPLY", "reply": 7, "source": "10.0.0.9"}')
+        ) is None
+
+    def test_write_only(self, monkeypatch):
+        """A Disco without a read topic only starts (and stops) the writer thread"""
+        monkeypatch.setattr("distributedlock.distributed.disco.DISCO_STARTUP_DELAY", 0)
+        monkeypatch.setattr("distributedlock.distributed.disco.Producer",
+                            lambda config: FakeProducer())
+        monkeypatch.setattr(Disco, "discovery", lambda self: None)
+        disco = Disco(broker="localhost", write_topic="test", auth=False)
+
+        with disco:
+            assert list(disco._thrds) == ["send"]
+
+        assert not disco._thrds["send"].is_alive()
+
+    def test_send(self):
+        """_send hands queued messages to the producer with a delivery callback"""
+        producer = FakeProducer()
+        self.disco._stream_w = producer
+        self.disco._out_queue.put(b"hello")
+        threading.Timer(0.2, self.disco._event.set).start()
+
+        Disco._send(self.disco)
+
+        assert producer.produced == [("test", b"hello", self.disco._on_delivery)]
+
+    def test_send_drains_on_shutdown(self):
+        """Messages still queued when shutdown starts are produced, not dropped"""
+        producer = FakeProducer()
+        self.disco._stream_w = producer
+        self.disco._out_queue.put(b"REPLY")
+        self.disco._out_queue.put(b"END")
+        self.disco.shutdown()
+
+        Disco._send(self.disco)
+
+        assert [value for _, value, _ in producer.produced] == [b"REPLY", b"END"]
+        assert self.disco._out_queue.empty()
+
+    def test_send_undelivered(self, caplog):
+        """Messages left after the final flush are logged"""
+        self.disco._stream_w = FakeProducer(undelivered=2)
+        self.disco._event.set()
+
+        Disco._send(self.disco)
+
+        assert "2 messages still undelivered" in caplog.text
+
+    def test_delivery_failure(self, caplog):
+        """A failed delivery report is logged"""
+        Disco._on_delivery("broker down", FakeMessage(b"hello"))
+
+        assert "broker down" in caplog.text
+
+
 class TestDisco:
     """
     How deep? Test sending, receiving messages?
@@ -163,6 +455,42 @@ class TestDistributedLock:
         assert isinstance(self.distributedlock.peers, list)
 
 
+class CountingCondition(threading.Condition):
+    """threading.Condition that counts notify_all() calls"""
+
+    def __init__(self):
+        super().__init__()
+        self.notified = 0
+
+    def notify_all(self):
+        self.notified += 1
+        super().notify_all()
+
+
+class TestLeaderState:
+    """ Test leader state change notification, without running the raft protocol """
+
+    def test_notify_on_change_only(self):
+        """setleaderstate() notifies only when the value actually changes"""
+        leader_state = Value("i", 0, lock=True)
+        leader_cond = CountingCondition()
+        distributedlock = DistributedLock(
+            "127.0.0.1:8100", ["127.0.0.1:8101", "127.0.0.1:8102", "127.0.0.1:8103"],
+            lockid="test", leader=leader_state, leader_cond=leader_cond
+        )
+
+        distributedlock.setleaderstate(False)
+        assert leader_cond.notified == 0
+
+        distributedlock.setleaderstate(True)
+        distributedlock.setleaderstate(True)
+        assert leader_cond.notified == 1
+        assert distributedlock.getleaderstate() == 1
+
+        distributedlock.setleaderstate(False)
+        assert leader_cond.notified == 2
+
+
 def watchdog_timeout():
     print("Watchdog time-out!")
     """ This hangs in the socket read, doesn't actually exit/end.